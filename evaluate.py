@@ -14,6 +14,7 @@ from tqdm import trange, tqdm
 import torch
 from torch.nn import functional as F
 from utils.fid import get_fid_value
+from utils.helpers import RunningMean
 import time 
 import wandb
 from functools import reduce
@@ -65,14 +66,14 @@ class Evaluator():
         data_loader: torch.utils.data.DataLoader
         """
         self.model.eval()
-        storer = defaultdict(list)
+        storer = defaultdict(RunningMean)
         for data, _ in tqdm(dataloader, leave=False):
             data = data.to(self.device)
 
             recon_batch, mu, logvar = self.model(data)
             _ = self.model.loss_function(recon_batch, data, mu, logvar, storer=storer)
             
-        losses = {k: sum(v) / len(dataloader)/batch_size for k, v in storer.items()}
+        losses = {k: v.value()/batch_size for k, v in storer.items()}
         self.model.train()
         return losses
 
@@ -82,7 +83,7 @@ class Evaluator():
         #TODO: dont run if on collab
         
         if dataset_name != '3dshapes' and dataset_name != 'mpi3dtoy' and dataset_name != 'dsprites':
-            fid = get_fid_value(dataloader, self.model, batch_size=dataloader.batch_size)
+            fid = get_fid_value(dataloader, self.model, batch_size=dataloader.batch_size, dataset_name=dataset_name)
         
         if dataset_name in ['dsprites', 'mpi3dtoy', '3dshapes']: 
             self.logger.info("Computing the disentanglement metric")
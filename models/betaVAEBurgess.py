@@ -119,12 +119,12 @@ class BetaVAEBurgess(BaseVAE):
         loss = recon_loss + self.beta  * kld_loss
 
         if storer is not None:
-            storer['recon_loss'].append(recon_loss.item())
-            storer['kl_loss'].append(kld_loss.item())
+            storer['recon_loss'].append(recon_loss.detach())
+            storer['kl_loss'].append(kld_loss.detach())
             for i in range(self.latent_dim):
                 
-                storer['kl_loss_' + str(i)].append(latent_kl[i].item())
-            storer['loss'].append(loss.item())
+                storer['kl_loss_' + str(i)].append(latent_kl[i].detach())
+            storer['loss'].append(loss.detach())
 
         return loss
 
@@ -7,14 +7,18 @@ from collections import defaultdict
 
 from tqdm import trange
 import torch
+import torch.distributed as dist
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
 from evaluate import Evaluator
+from utils.helpers import RunningMean
 
 import wandb
 
 TRAIN_LOSSES_LOGFILE = "train_losses.log"
 MODEL_FILENAME = "model.pt"
 META_FILENAME = "specs.json"
+POSTFIX_EVERY = 20
 
 class Trainer():
 
@@ -25,10 +29,19 @@ class Trainer():
         self.device = device
         self.model = model.to(self.device)
         self.optimizer = optimizer
+        if self.device.type == "cuda":
+            # use the multi-tensor implementation unless the caller chose one
+            # (e.g. `torch.optim.Adam(params, fused=True)`)
+            for group in self.optimizer.param_groups:
+                if group.get("foreach") is None and not group.get("fused"):
+                    group["foreach"] = True
         self.scheduler = scheduler
         self.save_dir = save_dir
         self.logger = logger
-        self.losses_logger = LossesLogger(os.path.join(save_dir, TRAIN_LOSSES_LOGFILE))
+        # with DistributedDataParallel only the first process logs, saves and evaluates
+        self.is_distributed = dist.is_available() and dist.is_initialized()
+        self.is_main = not self.is_distributed or dist.get_rank() == 0
+        self.losses_logger = LossesLogger(os.path.join(save_dir, TRAIN_LOSSES_LOGFILE)) if self.is_main else None
         self.metrics_freq =metrics_freq
         self.sample_size = sample_size
         self.dataset_size = dataset_size
@@ -36,13 +49,39 @@ class Trainer():
         self.gif_visualizer = gif_visualizer
         self.seed = seed
         self.dataset_name = dataset_name
+        self._make_storer = lambda: defaultdict(RunningMean)
+        self.use_amp = self.device.type == "cuda"
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.use_amp)
+
+        # wrapped (DDP) and compiled forward only, `self.model` stays the plain module
+        # so that its state_dict keys and attributes are unchanged for saving and evaluation
+        self.forward = self.model
+        if self.is_distributed:
+            device_ids = [torch.cuda.current_device()] if self.device.type == "cuda" else None
+            self.forward = DDP(self.model, device_ids=device_ids,
+                               gradient_as_bucket_view=True, broadcast_buffers=False)
+        if hasattr(torch, "compile") and self.device.type == "cuda":
+            torch._dynamo.config.suppress_errors = True
+            self.forward = torch.compile(self.forward, mode="reduce-overhead", fullgraph=False)
 
 
 
     def __call__(self, data_loader, epochs=10, checkpoint_every = 10, wandb_log = False):
+        """Train the model.
+
+        When `torch.distributed` is initialized, `data_loader` should use a
+        `DistributedSampler` so that each process gets its own shard of the data.
+        The per-epoch wandb evaluation is then skipped: it would only run on rank 0
+        while the other ranks wait in the next all-reduce, and long evaluations
+        (e.g. FID) would exceed the process group timeout.
+        """
         start = default_timer()
         storers = []
         self.model.train()
+        if wandb_log and self.is_distributed:
+            if self.is_main:
+                self.logger.warning("Skipping the per-epoch wandb evaluation in distributed training.")
+            wandb_log = False
 
 
         if wandb_log:
@@ -50,44 +89,57 @@ class Trainer():
                                         sample_size=self.sample_size, dataset_size=self.dataset_size, all_latents=self.all_latents)
 
         for epoch in range(epochs):
-            storer = defaultdict(list)
-            epoch_loss = 0
+            storer = self._make_storer()
+            epoch_loss = torch.zeros((), device=self.device)
+            if hasattr(data_loader.sampler, "set_epoch"):
+                data_loader.sampler.set_epoch(epoch)
 
             kwargs = dict(desc="Epoch {}".format(epoch + 1), leave=False,
-                      disable=False)
+                      disable=not self.is_main)
+            batches = CUDAPrefetcher(data_loader, self.device) if self.device.type == "cuda" else data_loader
             with trange(len(data_loader), **kwargs) as t:
 
-                for _, (data, _) in enumerate(data_loader):
+                for step, (data, _) in enumerate(batches):
                     batch_size, _, _, _ = data.size()
                     
                     
                     data = data.to(self.device)
-                    self.optimizer.zero_grad()
-                    recon_batch, mu, logvar = self.model(data)
-
-                    loss = self.model.loss_function(recon_batch, data, mu,logvar, storer=storer)/len(data)
-
-                    
-                    loss.backward()
-                    self.optimizer.step()
-
-                    epoch_loss += loss.item()
-                    t.set_postfix(loss=loss)
+                    self.optimizer.zero_grad(set_to_none=True)
+                    with torch.autocast("cuda", enabled=self.use_amp):
+                        recon_batch, mu, logvar = self.forward(data)
+
+                    # BCE and the KL log-variance terms are not safe in half precision
+                    with torch.autocast("cuda", enabled=False):
+                        loss = self.model.loss_function(recon_batch.float(), data, mu.float(),
+                                                        logvar.float(), storer=storer)/len(data)
+
+                    self.scaler.scale(loss).backward()
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+
+                    # reading the loss synchronizes with the device, so only do it every few steps
+                    epoch_loss += loss.detach()
+                    if step % POSTFIX_EVERY == 0:
+                        t.set_postfix(loss=epoch_loss.item() / (step + 1))
                     t.update()
 
-            mean_epoch_loss = epoch_loss / len(data_loader)
+            if self.is_distributed:
+                dist.all_reduce(epoch_loss)
+                epoch_loss /= dist.get_world_size()
+            mean_epoch_loss = (epoch_loss / len(data_loader)).item()
 
-            self.logger.info('Epoch: {} Average loss per image: {:.2f}'.format(epoch + 1,
-                                                                               mean_epoch_loss))
+            if self.is_main:
+                self.logger.info('Epoch: {} Average loss per image: {:.2f}'.format(epoch + 1,
+                                                                                   mean_epoch_loss))
 
-            self.losses_logger.log(epoch, storer)
+                self.losses_logger.log(epoch, storer)
   
-            if self.gif_visualizer is not None:
-                self.gif_visualizer()
+                if self.gif_visualizer is not None:
+                    self.gif_visualizer()
 
-            if epoch % checkpoint_every == 0:
-                save_model(self.model,self.save_dir,
-                           filename="model-{}.pt".format(epoch))
+                if epoch % checkpoint_every == 0:
+                    save_model(self.model,self.save_dir,
+                               filename="model-{}.pt".format(epoch))
 
             if self.scheduler is not None:
                 self.scheduler.step()
@@ -103,18 +155,65 @@ class Trainer():
 
             self.model.train()           
 
-        if self.gif_visualizer is not None:
+        if self.gif_visualizer is not None and self.is_main:
             self.gif_visualizer.save_reset()
 
         self.model.eval()
 
         delta_time = (default_timer() - start) / 60
-        self.logger.info('Finished training after {:.1f} min.'.format(delta_time))
+        if self.is_main:
+            self.logger.info('Finished training after {:.1f} min.'.format(delta_time))
 
 
 
 
 
+class CUDAPrefetcher(object):
+    """Iterate over a data loader while copying the next batch to the GPU on a
+    side stream, so that host to device copies overlap with computation.
+
+    The wrapped `DataLoader` should be built with `pin_memory=True` (otherwise
+    the copies are synchronous) and ideally `num_workers>=2` and
+    `persistent_workers=True`.
+    """
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.data_loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            data, labels = next(self.iterator)
+        except StopIteration:
+            self.next_data, self.next_labels = None, None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_data = data.to(self.device, non_blocking=True)
+            self.next_labels = labels.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        data, labels = self.next_data, self.next_labels
+        if data is None:
+            raise StopIteration
+
+        # tensors were allocated on the side stream but are used on the current one
+        data.record_stream(torch.cuda.current_stream())
+        labels.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return data, labels
+
+
 class LossesLogger(object):
     """Class definition for objects to write data to log files in a
     form which is then easy to be plotted.
@@ -137,9 +236,9 @@ class LossesLogger(object):
 
     def log(self, epoch, losses_storer):
         """Write to the log file """
-        for k, v in losses_storer.items():
-            log_string = ",".join(str(item) for item in [epoch, k, mean(v)])
-            self.logger.debug(log_string)
+        lines = ["{},{},{:.6g}".format(epoch, k, v.value()) for k, v in losses_storer.items()]
+        if lines:
+            self.logger.debug("\n".join(lines))
 
 
 def save_model(model, directory, metadata=None, filename=MODEL_FILENAME):
@@ -157,25 +256,21 @@ def save_model(model, directory, metadata=None, filename=MODEL_FILENAME):
     metadata : dict
         Metadata to save.
     """
-    device = next(model.parameters()).device
-    model.cpu()
-
     if metadata is None:
         # save the minimum required for loading
         metadata = dict(img_size=model.img_size, latent_dim=model.latent_dim,
                         model_type=model.model_type)
 
-    path_to_metadata = os.path.join(directory, filename)
+    path_to_metadata = os.path.join(directory, META_FILENAME)
 
     with open(path_to_metadata, 'w') as f:
         json.dump(metadata, f, indent=4, sort_keys=True)
 
     path_to_model = os.path.join(directory, filename)
-    torch.save(model.state_dict(), path_to_model)
-
-    model.to(device)  # restore device
+    # copy the weights to the host instead of moving the whole model back and forth
+    state_dict = model.state_dict()
+    cpu_state_dict = type(state_dict)((k, v.cpu()) for k, v in state_dict.items())
+    # keep the per-module versions used by `load_state_dict`
+    cpu_state_dict._metadata = getattr(state_dict, "_metadata", None)
+    torch.save(cpu_state_dict, path_to_model)
 
-# HELPERS
-def mean(l):
-    """Compute the mean of a list"""
-    return sum(l) / len(l)
\ No newline at end of file
@@ -70,7 +70,7 @@ def get_dataloaders(dataset, root=None, shuffle=True, pin_memory=True,
     kwargs :
         Additional arguments to `DataLoader`. Default values are modified.
     """
-    pin_memory = pin_memory and torch.cuda.is_available  # only pin if GPU available
+    pin_memory = pin_memory and torch.cuda.is_available()  # only pin if GPU available
     Dataset = get_dataset(dataset)
     dataset = Dataset(logger=logger) if root is None else Dataset(root=root, logger=logger)
 
@@ -1,57 +1,48 @@
 # libraries needed for FID
+import os
+import functools
+
 import torchvision.datasets as datasets
 import torch.utils.data as data
 
 import torch.nn as nn
+from torch.nn.functional import adaptive_avg_pool2d, interpolate
 
 from torchvision.transforms import ToTensor
 
 import numpy as np
 import torch
 import torchvision.transforms as TF
-from scipy import linalg
 
 import torchvision.models as models
 import torchvision.transforms as transforms
 
 from torch.utils.data.sampler import SubsetRandomSampler
-from torch.utils.data.sampler import SequentialSampler
 
 from utils.datasets import get_dataloaders, get_img_size, DATASETS
-from torch.utils.data import Dataset, TensorDataset, DataLoader
+from torch.utils.data import DataLoader
 
 import utils.inception
 from tqdm import tqdm
 
-INCEPTION_V3 = utils.inception.get_inception_v3()
-FID_EVAL_SIZE = 100000 # massive, code will train on full dataset
-
-class CustomTensorDataset(Dataset):
-# Tensor Dataset with support for Transforms
-    def __init__(self, tensors, transform=None):
-        assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
-        self.tensors = tensors
-        self.transform = transform
-
-    def __getitem__(self, index):
-        x = self.tensors[0][index]
-
-        if self.transform:
-            x = self.transform(x)
-
-        y = self.tensors[1][index]
-
-        return x, y
+@functools.lru_cache(maxsize=1)
+def _get_inception():
+    # InceptionV3 is only built (and its weights downloaded) the first time FID is computed
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = utils.inception.get_inception_v3().eval().to(device, memory_format=torch.channels_last)
+    # compiling only pays off on the GPU, on the CPU it adds a long first call for no speedup
+    if hasattr(torch, "compile") and device == 'cuda':
+        torch._dynamo.config.suppress_errors = True
+        model = torch.compile(model, mode="max-autotune")
+    return model
 
-    def __len__(self):
-        return self.tensors[0].size(0)
-    
-class NoneTransform(object):   
-    def __call__(self, image):       
-        return image
+FID_EVAL_SIZE = 100000 # massive, code will train on full dataset
+FID_CACHE_DIR = ".fid_cache"
 
 # TODO: get cuda working
-def _get_activations(dataloader, length, model, batch_size, dims, device='cuda' if torch.cuda.is_available() else 'cpu'):
+def _get_activations(dataloader, length, model, batch_size, dims, device='cuda' if torch.cuda.is_available() else 'cpu', transform_fn=None):
+    # transform_fn : optional function applied to each batch on the device before
+    #                InceptionV3, e.g. to get the reconstructions of a VAE
     model.eval()
     model = model.to(device)
 
@@ -60,31 +51,48 @@ def _get_activations(dataloader, length, model, batch_size, dims, device='cuda'
                'Setting batch size to data size'))
         batch_size = length
 
-    pred_arr = np.empty((length, dims))
+    pred_arr = torch.empty((length, dims), device=device, dtype=torch.float32)
 
     start_idx = 0
 
-    for batch, labels in tqdm(dataloader, desc="Evaluating InceptionV3"):
-        batch = batch.to(device)
+    with torch.inference_mode():
+        for batch, labels in tqdm(dataloader, desc="Evaluating InceptionV3"):
+            batch = batch.to(device, non_blocking=True)
+            if transform_fn is not None:
+                batch = transform_fn(batch)
+
+            # pad the last partial batch so the compiled model always sees the same shape
+            n_batch = batch.shape[0]
+            if n_batch < batch_size:
+                padding = batch.new_zeros((batch_size - n_batch,) + tuple(batch.shape[1:]))
+                batch = torch.cat([batch, padding], dim=0)
+
+            # grayscale to RGB and resize to the Inception input size, batched on the device
+            if batch.shape[1] == 1:
+                batch = batch.expand(batch.shape[0], 3, *batch.shape[2:])
+            batch = interpolate(batch.float(), size=(299, 299), mode='bilinear', align_corners=False)
+            batch = batch.contiguous(memory_format=torch.channels_last)
+            pred = model(batch)[0][:n_batch]
 
-        with torch.no_grad():
-            batch = batch.float()
-            pred = model(batch)[0]
+            # If model output is not scalar, apply global spatial average pooling.
+            # This happens if you choose a dimensionality not equal 2048.
+            if pred.size(2) != 1 or pred.size(3) != 1:
+                pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
 
-        # If model output is not scalar, apply global spatial average pooling.
-        # This happens if you choose a dimensionality not equal 2048.
-        if pred.size(2) != 1 or pred.size(3) != 1:
-            pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
+            pred = pred.squeeze(3).squeeze(2)
 
-        pred = pred.squeeze(3).squeeze(2).cpu().numpy()
+            pred_arr[start_idx:start_idx + pred.shape[0]] = pred
 
-        pred_arr[start_idx:start_idx + pred.shape[0]] = pred
+            start_idx = start_idx + pred.shape[0]
 
-        start_idx = start_idx + pred.shape[0]
+    return pred_arr[:start_idx]
 
-    return pred_arr
+def _sym_sqrt(sigma):
+    # Square root of a symmetric positive semi-definite matrix.
+    w, v = np.linalg.eigh(sigma)
+    return (v * np.sqrt(np.clip(w, 0, None))).dot(v.T)
 
-def _calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
+def _calculate_frechet_distance(mu1, sigma1, mu2, sigma2):
     # Calculation of Frechet Distance.
     # Params:
     # mu1   : Numpy array containing the activations of a layer of the
@@ -97,39 +105,28 @@ def _calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     # Returns:
     #       : The Frechet Distance.
 
-    mu1 = np.atleast_1d(mu1)
-    mu2 = np.atleast_1d(mu2)
+    mu1 = np.atleast_1d(mu1).astype(np.float64)
+    mu2 = np.atleast_1d(mu2).astype(np.float64)
 
-    sigma1 = np.atleast_2d(sigma1)
-    sigma2 = np.atleast_2d(sigma2)
+    sigma1 = np.atleast_2d(sigma1).astype(np.float64)
+    sigma2 = np.atleast_2d(sigma2).astype(np.float64)
 
     assert mu1.shape == mu2.shape,               'Training and test mean vectors have different lengths'
     assert sigma1.shape == sigma2.shape,         'Training and test covariances have different dimensions'
 
     diff = mu1 - mu2
 
-    # Product might be almost singular
-    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
-    if not np.isfinite(covmean).all():
-        msg = ('fid calculation produces singular product; '
-               'adding %s to diagonal of cov estimates') % eps
-        print(msg)
-        offset = np.eye(sigma1.shape[0]) * eps
-        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
-
-    # Numerical error might give slight imaginary component
-    if np.iscomplexobj(covmean):
-        if not np.allclose(np.diagonal(covmean).imag, 0, atol=1e-3):
-            m = np.max(np.abs(covmean.imag))
-            raise ValueError('Imaginary component {}'.format(m))
-        covmean = covmean.real
-
-    tr_covmean = np.trace(covmean)
+    # sigma1 and sigma2 are symmetric PSD, so tr(sqrt(sigma1 sigma2)) equals
+    # tr(sqrt(sigma1^1/2 sigma2 sigma1^1/2)), whose argument is symmetric PSD
+    # and can be handled by eigh instead of the much slower Schur-based sqrtm
+    s1_sqrt = _sym_sqrt(sigma1)
+    eigvals = np.linalg.eigvalsh(s1_sqrt.dot(sigma2).dot(s1_sqrt))
+    tr_covmean = np.sqrt(np.clip(eigvals, 0, None)).sum()
 
     return (diff.dot(diff) + np.trace(sigma1)
             + np.trace(sigma2) - 2 * tr_covmean)
 
-def _calculate_activation_statistics(dataloader, length, model, batch_size=128, dims=2048):
+def _calculate_activation_statistics(dataloader, length, model, batch_size=128, dims=2048, transform_fn=None):
     # Calculation of the statistics used by the FID.
     # Params:
     # length      : Number of samples
@@ -139,124 +136,79 @@ def _calculate_activation_statistics(dataloader, length, model, batch_size=128,
     #               depends on the hardware.
     # dims        : Dimensionality of features returned by model
     # device      : Device to run calculations
+    # transform_fn: Optional function applied to each batch before the model
     # Returns:
     # mu    : The mean over samples of the activations of the pool_3 layer of
     #         the model.
     # sigma : The covariance matrix of the activations of the pool_3 layer of
     #         the model.
         
-    act = _get_activations(dataloader, length, model, batch_size, dims)
+    act = _get_activations(dataloader, length, model, batch_size, dims, transform_fn=transform_fn)
     print("Sucessfully got InceptionV3 activations")
-    mu = np.mean(act, axis=0)
-    sigma = np.cov(act, rowvar=False)
-    return mu, sigma
-
-def get_fid_value(dataloader, vae_model, batch_size = 128):
+    return _activation_statistics(act)
+
+def _activation_statistics(act):
+    # Mean and covariance of a (num_samples, dims) tensor of activations.
+    # Statistics are computed on the activations' device, only mu and sigma
+    # are moved back to numpy.
+    mu = act.mean(dim=0)
+    act_centered = act - mu
+    sigma = act_centered.T @ act_centered / (act.shape[0] - 1)
+    return mu.cpu().numpy(), sigma.cpu().numpy()
+
+def _fid_stats_cache(dataset_id):
+    # Path of the file caching the InceptionV3 statistics of a real dataset.
+    return os.path.join(FID_CACHE_DIR, dataset_id + '.npz')
+
+def get_fid_value(dataloader, vae_model, batch_size = 128, dataset_name = None):
     # Calculate FID value
     # Params:
     # dataloader : data to test on
     # vae_model : model to evaluate
     # batch_size : batch size when evaluating model
+    # dataset_name : if given, the statistics of the original images are cached
+    #                on disk and reused by later calls on the same dataset
 
-    length = len(dataloader.dataset)
-    model = INCEPTION_V3
+    model = _get_inception()
+    dims = 2048
 
-    # calculated reconstructed data using VAE
-#     vae_output = []
-#     vae_label = []
     vae_model.eval()
     device='cuda' if torch.cuda.is_available() else 'cpu'
-#    device = 'cpu' # Override for now
     vae_model = vae_model.to(device)
-    
-#     original_input = []
-#     original_label = []
-    
-#     print("Running VAE model.")
-#     for inputs, labels in dataloader:
-#         inputs = inputs.to(device)
-#         with torch.no_grad():
-#             outputs = vae_model(inputs)[0]
-#         for i in range(outputs.shape[0]):
-#             vae_output.append(outputs[i])
-#             original_input.append(inputs[i])
-#             vae_label.append(labels[i])
-#             original_label.append(labels[i])
-#     original_input = torch.stack(original_input)
-#     original_label = torch.stack(original_label)
-#     vae_output = torch.stack(vae_output)
-#     vae_label = torch.stack(vae_label)
-#     print(vae_output.shape)
-
-    for inputs, labels in dataloader:
-        shapeI = list(inputs[0].shape)
-        shapeL = list(labels[0].shape)
-        break
-    
 
-    shapeI.insert(0, batch_size)
-    shapeL.insert(0, batch_size)
+    # Get a random subset of the images from the dataset you want to compare FID scores for.
+    # Originals and reconstructions are streamed from it straight into InceptionV3,
+    # the reconstructions being computed batch by batch.
+    dataset = dataloader.dataset
+    num_samples = min(FID_EVAL_SIZE, len(dataset))
+    subset_indices = np.random.choice(len(dataset), num_samples, replace=False)
+    # the same loader serves both passes, so its workers are kept alive in between
+    subset_loader = DataLoader(dataset, batch_size=batch_size,
+                               sampler=SubsetRandomSampler(subset_indices.tolist()),
+                               num_workers=max(2, (os.cpu_count() or 4) // 2),
+                               pin_memory=torch.cuda.is_available(),
+                               persistent_workers=True, prefetch_factor=4)
+
+    cache_path = None
+    if dataset_name is not None:
+        shapeI = dataset[0][0].shape
+        dataset_id = "{}_{}_{}".format(dataset_name, len(dataset), "x".join(str(d) for d in shapeI))
+        cache_path = _fid_stats_cache(dataset_id)
+
+    if cache_path is not None and os.path.isfile(cache_path):
+        cached = np.load(cache_path)
+        m1, s1 = cached["mu"], cached["sigma"]
+        print("Loaded m1 and s1 from", cache_path)
+    else:
+        m1, s1 = _calculate_activation_statistics(subset_loader, num_samples, model, batch_size, dims)
+        print("Calculated m1 and s1")
+        if cache_path is not None:
+            os.makedirs(FID_CACHE_DIR, exist_ok=True)
+            np.savez(cache_path, mu=m1, sigma=s1)
 
-    original_input = np.empty(shapeI)
-    original_label = np.empty(shapeL)
-    vae_output = np.empty(shapeI)
-    
-    count = 0
     print("Running VAE model on device", device)
-    for inputs, labels in tqdm(dataloader, desc="Evaluating VAE"):
-        
-        inputs = inputs.to(device)
-        with torch.no_grad():
-            outputs = vae_model(inputs)[0]
-               
-        if count != 0: # if not first batch then just append by concatenation
-            original_input = np.concatenate((original_input, inputs.cpu().detach().numpy()), axis=0)
-            original_label = np.concatenate((original_label, labels.cpu().detach().numpy()), axis=0)
-            vae_output = np.concatenate((vae_output, outputs.cpu().detach().numpy()), axis=0)
-        else:
-            original_input[:original_input.shape[0]] = inputs.cpu().detach().numpy()
-            original_label[:original_input.shape[0]] = labels.cpu().detach().numpy()
-            vae_output[:original_input.shape[0]] = outputs.cpu().detach().numpy()
-        
-        count = count + 1
-    
-    original_input = torch.from_numpy(original_input)
-    original_label = torch.from_numpy(original_label)
-    vae_output = torch.from_numpy(vae_output)
-    vae_label = original_label
-    print("Tensor shape:", vae_output.shape)
-    
-    print("Outputs calculated. Constructing dataloader.")
-
-    # Get a random subset of the images from the dataset you want to compare FID scores for
-    num_samples = min(FID_EVAL_SIZE, len(dataloader.dataset))
-    subset_indices = list(np.random.choice(len(dataloader.dataset), num_samples, replace=False))
-    sampler=SequentialSampler(subset_indices)
-    
-    Transform = transforms.Compose([transforms.Resize((299, 299)), transforms.Lambda(lambda x: x.repeat(3, 1, 1))  if vae_output.shape[1]==1  else NoneTransform()])
-    
-    dataset_reconstructed = CustomTensorDataset(tensors=(vae_output, vae_label), transform = Transform)
-    dataloader_reconstructed = DataLoader(dataset_reconstructed, batch_size=batch_size, sampler=sampler)
-    print("dataloader_reconstructed built. Shape is ", dataset_reconstructed[1][0].shape)
-    #print(dataset_reconstructed[1][0].shape)
-
-    # get the model dimensions
-    for inputs, labels in dataloader:
-        pred = inputs
-        size = pred.size()[1:] # discard batch size
-        dims = 1
-        for dim in size:
-            dims *= dim
-        break
-    dims = 2048 # override for now
-    
-    dataset_original = CustomTensorDataset(tensors=(original_input, original_label), transform = Transform)
-    dataloader_original = DataLoader(dataset_original, batch_size=batch_size, sampler=sampler)
-    print("dataloader_original built. Shape is ", dataset_original[1][0].shape)
-    
-    m1, s1 = _calculate_activation_statistics(dataloader_original, length, model, batch_size, dims)
-    print("Calculated m1 and s1")
-    m2, s2 = _calculate_activation_statistics(dataloader_reconstructed, length, model, batch_size, dims)
+    m2, s2 = _calculate_activation_statistics(subset_loader, num_samples, model, batch_size, dims,
+                                              transform_fn=lambda x: vae_model(x)[0])
     print("Calculated m2 and s2")
 
     fid_value = _calculate_frechet_distance(m1, s1, m2, s2)
@@ -81,6 +81,27 @@ def check_bounds(value, type=float, lb=-float("inf"), ub=float("inf"),
     return value
 
 
+class RunningMean(object):
+    """Running mean of scalar tensors which only synchronizes with the device
+    when the value is read.
+    """
+
+    def __init__(self):
+        self.s = 0.
+        self.n = 0
+
+    def add(self, t):
+        self.s += t.detach() if torch.is_tensor(t) else t
+        self.n += 1
+
+    # list-like interface used by the models' `loss_function` storers
+    append = add
+
+    def value(self):
+        """Return the mean as a python float."""
+        return float(self.s / self.n)
+
+
 class FormatterNoDuplicate(argparse.ArgumentDefaultsHelpFormatter):
     """Formatter overriding `argparse.ArgumentDefaultsHelpFormatter` to show
     `-e, --epoch EPOCH` instead of `-e EPOCH, --epoch EPOCH`